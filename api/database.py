@@ -3,28 +3,42 @@ import os
 import csv
 from io import StringIO
 
+EXTRACTED_FIELDS_COLUMNS = (
+    'client_id', 'doc_url', 'doc_name', 'doc_status', 'doc_type',
+    'field_name', 'field_value', 'confidence', 'access_id',
+)
+
 class Database:
+    # Shared by every Database instance; created once in app startup
+    pool: asyncpg.Pool = None
+
     def __init__(self, client_id, doc_url):
         self.client_id = client_id
         self.doc_url = doc_url
-        self.conn = None
-        
-    async def ensure_connected(self):
-        if self.conn is None:
-            await self.connect()
 
-    async def connect(self):
-        self.conn = await asyncpg.connect(
-            database="postgres",
-            user="postgres",
-            password="kr3310",
-            host="localhost",
-            port="5432"
-        )
-        await self.create_table()
+    @classmethod
+    async def init_pool(cls):
+        if cls.pool is None:
+            cls.pool = await asyncpg.create_pool(
+                database="postgres",
+                user="postgres",
+                password="kr3310",
+                host="localhost",
+                port="5432",
+                min_size=5,
+                max_size=25,
+            )
+            async with cls.pool.acquire() as conn:
+                await cls.create_table(conn)
 
-    async def create_table(self):
-        await self.ensure_connected()
+    @classmethod
+    async def close_pool(cls):
+        if cls.pool is not None:
+            await cls.pool.close()
+            cls.pool = None
+
+    @staticmethod
+    async def create_table(conn):
         create_table_query = """
         CREATE TABLE IF NOT EXISTS client_docs (
             id SERIAL PRIMARY KEY,
@@ -37,7 +51,7 @@ class Database:
             access_id TEXT
         );
         """
-        await self.conn.execute(create_table_query)
+        await conn.execute(create_table_query)
         
         create_extracted_fields_table_query = """
         CREATE TABLE IF NOT EXISTS extracted_fields (
@@ -53,40 +67,44 @@ class Database:
             access_id TEXT
         );
         """
-        await self.conn.execute(create_extracted_fields_table_query)
+        await conn.execute(create_extracted_fields_table_query)
 
     async def post2postgres_upload(self, client_id, doc_url, doc_status, doc_type, container_name, access_id):
-        await self.ensure_connected()
         doc_name = os.path.basename(doc_url)  
         insert_query = """
         INSERT INTO client_docs (client_id, doc_url, doc_name, doc_status, doc_type, container_name, access_id)  
         VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id;
         """
-        last_inserted_id = await self.conn.fetchval(insert_query, client_id, doc_url, doc_name, doc_status, doc_type, container_name, access_id)
+        async with self.pool.acquire() as conn:
+            last_inserted_id = await conn.fetchval(insert_query, client_id, doc_url, doc_name, doc_status, doc_type, container_name, access_id)
         return last_inserted_id
     
-    async def post2postgres_extract(self, client_id, doc_url, doc_name, doc_status, doc_type, field_name, field_value, confidence, access_id):
-        await self.ensure_connected()
-        insert_query = """
-        INSERT INTO extracted_fields (client_id, doc_url, doc_name, doc_status, doc_type, field_name, field_value, confidence, access_id) 
-        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) RETURNING id;
-        """
-        # Use fetchval to execute the query and get the returned value
-        last_inserted_id = await self.conn.fetchval(insert_query, client_id, doc_url, doc_name, doc_status, doc_type, field_name, field_value, confidence, access_id)
+    async def post2postgres_extract_many(self, client_id, doc_url, records):
+        # A document with no fields is not marked as extracted
+        if not records:
+            return 0
 
         update_status_query = """
         UPDATE client_docs SET doc_status = 'extracted' WHERE client_id = $1 AND doc_url = $2;
         """
-        # Use execute for the update query as it does not return a value
-        await self.conn.execute(update_status_query, client_id, doc_url)
-        
-        return last_inserted_id
+        # One connection and transaction, so the status only changes if the fields were stored
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Binary COPY loads every field of the document in a single round-trip
+                await conn.copy_records_to_table(
+                    'extracted_fields',
+                    records=records,
+                    columns=EXTRACTED_FIELDS_COLUMNS,
+                )
+                await conn.execute(update_status_query, client_id, doc_url)
+
+        return len(records)
     
     async def generate_csv(self, document_id, client_id):
-        await self.ensure_connected()
         # Query to fetch all fields and values for a specific document and client
         query = """ SELECT field_name, field_value, confidence FROM extracted_fields WHERE doc_name = $1 AND client_id = $2"""
-        rows = await self.conn.fetch(query, document_id, client_id)
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(query, document_id, client_id)
         # Initialize CSV output in memory
         output = StringIO()
         csv_writer = csv.writer(output)
@@ -106,7 +124,3 @@ class Database:
         output.seek(0)
 
         return csv_content
-
-    async def close(self):
-        if self.conn is not None:
-            await self.conn.close()
\ No newline at end of file
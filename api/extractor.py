@@ -3,154 +3,342 @@ from azure.storage.blob import generate_blob_sas, BlobSasPermissions
 from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeResult, AnalyzeDocumentRequest
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport
+import aiohttp
 import azure_credentials
 from database import Database
-import json
+import orjson
 import datetime
 import asyncio
+from collections.abc import Mapping
+import logging
+import time
+from typing import Any, NamedTuple
 from form_mapping_utils import extractor_model_mapping
 
+log = logging.getLogger(__name__)
+
+# Caps in-flight Document Intelligence analyses to stay within the service TPS limits
+ANALYZE_CONCURRENCY = 16
+_analyze_semaphore = None
+# Worker counts for run_extraction_pipeline; the persist queue bound gives
+# backpressure when the database falls behind analysis
+ANALYZE_WORKERS = ANALYZE_CONCURRENCY
+PERSIST_WORKERS = 4
+PERSIST_QUEUE_SIZE = 32
+
+# Process-wide Azure clients, kept open so their HTTP connections are
+# reused across extract() calls
+_http_session = None
+_blob_service_client = None
+_document_intelligence_clients = {}
+
+
+def _transport():
+    """Returns a transport over the aiohttp session shared by all Azure clients."""
+    return AioHttpTransport(session=_http_session, session_owner=False)
+
+
+def init_clients():
+    """Creates the process-wide extraction state; called once in app startup."""
+    global _analyze_semaphore, _http_session, _blob_service_client
+    _analyze_semaphore = asyncio.Semaphore(ANALYZE_CONCURRENCY)
+    _http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=64, keepalive_timeout=75)
+    )
+    _blob_service_client = BlobServiceClient.from_connection_string(
+        azure_credentials.CONNECTION_STRING,
+        transport=_transport(),
+    )
+    _document_intelligence_clients['prebuilt'] = DocumentIntelligenceClient(
+        endpoint=azure_credentials.FORM_RECOGNIZER_ENDPOINT_PREBUILT,
+        credential=AzureKeyCredential(azure_credentials.FORM_RECOGNIZER_KEY_PREBUILT),
+        transport=_transport(),
+    )
+    _document_intelligence_clients['custom_k1'] = DocumentIntelligenceClient(
+        endpoint=azure_credentials.FORM_RECOGNIZER_ENDPOINT_CUSTOM,
+        credential=AzureKeyCredential(azure_credentials.FORM_RECOGNIZER_KEY_CUSTOM_K1),
+        transport=_transport(),
+    )
+
+
+async def close_clients():
+    """Closes the clients created by init_clients; called once in app shutdown."""
+    global _http_session, _blob_service_client
+    for client in _document_intelligence_clients.values():
+        await client.close()
+    _document_intelligence_clients.clear()
+    if _blob_service_client is not None:
+        await _blob_service_client.close()
+        _blob_service_client = None
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+class Field(NamedTuple):
+    """An extracted field value and the service's confidence in it."""
+    value: Any
+    confidence: float
+
+
+class ExtractionJob(NamedTuple):
+    """A blob to analyze and persist with run_extraction_pipeline."""
+    client_id: str
+    container_name: str
+    blob_name: str
+    doc_name: str
+    form_type: str
+    access_id: str
+
+
+# Maps a Document Intelligence field type to the key holding its value
+_VALUE_KEY = {
+    'string': 'valueString',
+    'number': 'valueNumber',
+    'integer': 'valueInteger',
+    'date': 'valueDate',
+    'time': 'valueTime',
+    'phoneNumber': 'valuePhoneNumber',
+    'selectionMark': 'valueSelectionMark',
+    'countryRegion': 'valueCountryRegion',
+    'boolean': 'valueBoolean',
+    'currency': 'valueCurrency',
+    'address': 'valueAddress',
+}
+
+# SAS tokens are valid for an hour and regenerated every half hour, so a
+# cached token always has at least 30 minutes left
+SAS_REFRESH_SECONDS = 1800
+_SAS_LIFETIME = datetime.timedelta(hours=1)
+_SAS_CACHE_SIZE = 4096
+_sas_cache = {}
+
+
+def _generate_sas(account_name, container_name, blob_location):
+    return generate_blob_sas(
+        account_name=account_name,
+        container_name=container_name,
+        blob_name=blob_location,
+        account_key=azure_credentials.KEY,
+        permission=BlobSasPermissions(read=True),
+        expiry=datetime.datetime.now(datetime.timezone.utc) + _SAS_LIFETIME
+    )
+
+
+async def _sas_for(account_name, container_name, blob_location):
+    key = (account_name, container_name, blob_location, int(time.time()) // SAS_REFRESH_SECONDS)
+    sas_token = _sas_cache.get(key)
+    if sas_token is None:
+        # Signing is synchronous HMAC work; keep it off the event loop
+        sas_token = await asyncio.to_thread(_generate_sas, account_name, container_name, blob_location)
+        if len(_sas_cache) >= _SAS_CACHE_SIZE:
+            _sas_cache.clear()
+        _sas_cache[key] = sas_token
+    return sas_token
+
+
+# Address components flattened into "<field>_Address_<component>" entries
+_ADDRESS_FIELDS = ("house_number", "road", "city", "state", "postal_code")
+
+
+def _handle_scalar(field_name, field, w2_dict):
+    """Stores the value and confidence of a field in w2_dict under field_name."""
+    get = field.get
+    w2_dict[field_name] = Field(get(_VALUE_KEY.get(get('type'), 'value')), get('confidence'))
+
+
+def _handle_person(field_name, field, w2_dict):
+    """Flattens the sub-fields of a person/party object, including its address."""
+    log.debug("%s data:", field_name)
+    person_data = field.get('valueObject')
+    for sub_field_name, sub_field in person_data.items():
+        if sub_field_name == "Address":
+            address_value = sub_field.get('valueAddress')
+            # Assumes confidence is the same for all components
+            confidence = sub_field.confidence
+            for component_name in _ADDRESS_FIELDS:
+                component_value = getattr(address_value, component_name)
+                w2_dict[f"{field_name}_Address_{component_name}"] = Field(component_value, confidence)
+                log.debug("...%s: %s has confidence: %s", component_name.capitalize(), component_value, confidence)
+        else:
+            value = sub_field.get(_VALUE_KEY.get(sub_field.get('type'), 'value'))
+            confidence = sub_field.confidence
+            w2_dict[f"{field_name}_{sub_field_name}"] = Field(value, confidence)
+            log.debug("...%s: %s has confidence: %s", sub_field_name, value, confidence)
+
+
+def _handle_array(field_name, field, w2_dict):
+    """Stores the fields of arrays of additional info, state, and local tax infos in w2_dict."""
+    log.debug("%s:", field_name)
+    for idx, item in enumerate(field.get('valueArray', [])):
+        item_prefix = f"{field_name}_{idx+1}"
+        for key, value in item.get('valueObject', {}).items():
+            _handle_scalar(f"{item_prefix}_{key}", value, w2_dict)
+
+
+# Routes each top-level field to its parser; anything else is a scalar field
+_FIELD_HANDLERS = {
+    name: _handle_person
+    for name in ("Employee", "Employer", "Borrower", "Lender", "Payer", "Recipient")
+}
+_FIELD_HANDLERS.update({
+    name: _handle_array
+    for name in ("AdditionalInfo", "StateTaxInfos", "LocalTaxInfos", "StateTaxesWithheld")
+})
+
 
 class Extractor:
     def __init__(self, container_name):
-        self.blob_service_client = BlobServiceClient.from_connection_string(
-            azure_credentials.CONNECTION_STRING
-        )
+        self.blob_service_client = _blob_service_client
         self.blob_container_client = self.blob_service_client.get_container_client(
             container_name
         )
+        self._account = self.blob_service_client.account_name
+        self._container = self.blob_container_client.container_name
+        self._url_prefix = f"https://{self._account}.blob.core.windows.net/{self._container}"
 
     async def update_database(self, client_id, blob_sas_url, doc_name, form_type, extracted_values, access_id):
         database = Database(client_id, blob_sas_url)
         try:
+            records = []
             for extracted_value in extracted_values:
                 for field_name, field_data in extracted_value.items():
-                    if isinstance(field_data, dict):
-                        field_value = str(field_data['value'])
-                        confidence = field_data['confidence']
+                    if isinstance(field_data, Field):
+                        raw_value = field_data.value
+                        confidence = field_data.confidence
                     else:
-                        field_value = str(field_data)
+                        raw_value = field_data
                         confidence = None
 
-                    # Check if the value is of a custom type and convert it
-                    if isinstance(field_value, list):
-                        field_value = json.dumps(field_value.__dict__)
-
-                    last_inserted_id = await database.post2postgres_extract(
-                        client_id=client_id,
-                        doc_url=blob_sas_url,
-                        doc_name=doc_name,
-                        doc_status='extracted',
-                        doc_type=form_type,
-                        field_name=field_name,
-                        field_value=field_value,
-                        confidence=confidence,
-                        access_id=access_id,
-                    )
-                    print(f"Last inserted ID for extraction: {last_inserted_id}")
+                    # Encode structured values as JSON, everything else as text
+                    if isinstance(raw_value, (list, Mapping)):
+                        # SDK models (currency, address) are mappings rather than dicts
+                        field_value = orjson.dumps(raw_value, default=dict).decode()
+                    else:
+                        field_value = str(raw_value)
+
+                    records.append((
+                        client_id,
+                        blob_sas_url,
+                        doc_name,
+                        'extracted',
+                        form_type,
+                        field_name,
+                        field_value,
+                        confidence,
+                        access_id,
+                    ))
+
+            inserted_count = await database.post2postgres_extract_many(client_id, blob_sas_url, records)
+            log.debug("Inserted %d extracted fields for '%s'", inserted_count, doc_name)
         except Exception as e:
-            print(f"An error occurred while inserting field '{field_name}': {e}")
-        finally:
-            await database.close()
+            log.error("An error occurred while inserting fields for '%s': %s", doc_name, e)
+            raise
             
     def get_document_intelligence_client(self, form_type):
         if form_type != 'K1-1065':
-            endpoint = azure_credentials.FORM_RECOGNIZER_ENDPOINT_PREBUILT
-            key = azure_credentials.FORM_RECOGNIZER_KEY_PREBUILT
-        else:
-            endpoint = azure_credentials.FORM_RECOGNIZER_ENDPOINT_CUSTOM
-            key = azure_credentials.FORM_RECOGNIZER_KEY_CUSTOM_K1
-            
-        return DocumentIntelligenceClient(endpoint=endpoint, credential=AzureKeyCredential(key))
+            return _document_intelligence_clients['prebuilt']
+        return _document_intelligence_clients['custom_k1']
       
     async def extract(self, client_id, blob_name, form_type):
         document_intelligence_client = self.get_document_intelligence_client(form_type)
         blob_location = f"{client_id}/{blob_name}"
-        sas_token = generate_blob_sas(
-            account_name=self.blob_service_client.account_name,
-            container_name=self.blob_container_client.container_name,
-            blob_name=blob_location,
-            account_key=azure_credentials.KEY,
-            permission=BlobSasPermissions(read=True),
-            expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        sas_token = await _sas_for(
+            self._account,
+            self._container,
+            blob_location,
         )
 
-        blob_sas_url = f"https://{self.blob_service_client.account_name}.blob.core.windows.net/{self.blob_container_client.container_name}/{blob_location}?{sas_token}"
-        doc_url = f"https://{self.blob_service_client.account_name}.blob.core.windows.net/{self.blob_container_client.container_name}/{blob_location}"
+        doc_url = f"{self._url_prefix}/{blob_location}"
+        blob_sas_url = f"{doc_url}?{sas_token}"
 
-        # Use async with for proper context management of the async client
-        async with document_intelligence_client as client:
-            poller = await client.begin_analyze_document(
+        # The client is shared for the process lifetime, so it is not closed here
+        async with _analyze_semaphore:
+            poller = await document_intelligence_client.begin_analyze_document(
                 extractor_model_mapping.get(form_type, 'unsorted'),
                 AnalyzeDocumentRequest(url_source=blob_sas_url)
             )
             result: AnalyzeResult = await poller.result()
-            
-        def extract_address_values(address_value):
-            """Extracts individual address components into a dictionary."""
-            return {
-                "house_number": address_value.house_number,
-                "road": address_value.road,
-                "city": address_value.city,
-                "state": address_value.state,
-                "postal_code": address_value.postal_code
-            }
-            
-        def extract_field_info(field, prefix=''):
-            """Extracts information from a field with value and confidence."""
-            value = field.get('valueString') or field.get('valueNumber') or field.get('value')
-            confidence = field.get('confidence')
-            return {prefix: {'value': value, 'confidence': confidence}}
-
-        def extract_array_info(array, prefix):
-            """Extracts information from arrays of additional info, state, and local tax infos."""
-            array_info = {}
-            for idx, item in enumerate(array):
-                item_prefix = f"{prefix}_{idx+1}"
-                for key, value in item.get('valueObject', {}).items():
-                    field_info = extract_field_info(value, prefix=f"{item_prefix}_{key}")
-                    array_info.update(field_info)
-            return array_info
-        
+
         response_list = []
         for idx, result in enumerate(result.documents):
-            print(f"--------Recognizing {form_type} #{idx}--------")
+            log.debug("--------Recognizing %s #%d--------", form_type, idx)
             w2_dict = {}
             for field_name, field in result.fields.items():
-                if field_name in ["Employee", "Employer", "Borrower", "Lender", "Payer", "Recipient"]:
-                    print(f"{field_name} data:")
-                    person_data = field.get('valueObject')
-                    for sub_field_name, sub_field in person_data.items():
-                        if sub_field_name == "Address":
-                            address_components = extract_address_values(sub_field.get('valueAddress'))
-                            for component_name, component_value in address_components.items():
-                                component_key = f"{field_name}_Address_{component_name}"
-                                w2_dict[component_key] = {
-                                    'value': component_value,
-                                    'confidence': sub_field.confidence  # Assumes confidence is the same for all components
-                                }
-                                print(f"...{component_name.capitalize()}: {component_value} has confidence: {sub_field.confidence}")
-                        else:
-                            value = sub_field.get('valueString') or sub_field.get('valueNumber') or sub_field.get('value')
-                            confidence = sub_field.confidence
-                            w2_dict[f"{field_name}_{sub_field_name}"] = {
-                                'value': value,
-                                'confidence': confidence
-                            }
-                            print(f"...{sub_field_name}: {value} has confidence: {confidence}")
-                # Handling arrays of AdditionalInfo, StateTaxInfos, and LocalTaxInfos
-                elif field_name in ["AdditionalInfo", "StateTaxInfos", "LocalTaxInfos", "StateTaxesWithheld"]:
-                    print(f"{field_name}:")
-                    array_data = extract_array_info(field.get('valueArray', []), prefix=field_name)
-                    w2_dict.update(array_data)
-
-                else:
-                    # Handle other fields similarly
-                    field_info = extract_field_info(field, prefix=field_name)
-                    w2_dict.update(field_info)
+                handler = _FIELD_HANDLERS.get(field_name, _handle_scalar)
+                handler(field_name, field, w2_dict)
 
             response_list.append(w2_dict)
-            print(w2_dict)
-            print("----------------------------------------")
+            log.debug("%s", w2_dict)
+            log.debug("----------------------------------------")
 
         return response_list, doc_url
+
+
+async def run_extraction_pipeline(pending_jobs):
+    """Analyzes and persists documents, overlapping Document Intelligence calls with database writes.
+
+    pending_jobs are awaitables (such as uploads) that each resolve to an ExtractionJob, or to None
+    when there is nothing to extract; a job enters analysis as soon as its own awaitable finishes.
+    Returns one entry per awaitable, in order: the extracted values, the exception raised, or None.
+    """
+    results = [None] * len(pending_jobs)
+    analyze_q = asyncio.Queue()
+    persist_q = asyncio.Queue(maxsize=PERSIST_QUEUE_SIZE)
+
+    async def enqueue(idx, pending_job):
+        try:
+            job = await pending_job
+        except Exception as e:
+            log.error("Preparing extraction job #%d failed: %s", idx, e)
+            results[idx] = e
+            return
+        if job is not None:
+            await analyze_q.put((idx, job))
+
+    async def analyze_worker():
+        while True:
+            item = await analyze_q.get()
+            if item is None:
+                return
+            idx, job = item
+            try:
+                extractor = Extractor(job.container_name)
+                extracted_values, doc_url = await extractor.extract(job.client_id, job.blob_name, job.form_type)
+            except Exception as e:
+                log.error("Extraction failed for '%s': %s", job.doc_name, e)
+                results[idx] = e
+                continue
+            await persist_q.put((idx, job, extractor, extracted_values, doc_url))
+
+    async def persist_worker():
+        while True:
+            item = await persist_q.get()
+            if item is None:
+                return
+            idx, job, extractor, extracted_values, doc_url = item
+            try:
+                await extractor.update_database(
+                    job.client_id, doc_url, job.doc_name, job.form_type, extracted_values, job.access_id
+                )
+                results[idx] = extracted_values
+            except Exception as e:
+                # update_database has already logged the failure
+                results[idx] = e
+
+    analyzers = [asyncio.create_task(analyze_worker()) for _ in range(min(ANALYZE_WORKERS, len(pending_jobs)))]
+    persisters = [asyncio.create_task(persist_worker()) for _ in range(min(PERSIST_WORKERS, len(pending_jobs)))]
+    try:
+        await asyncio.gather(*(enqueue(idx, pending_job) for idx, pending_job in enumerate(pending_jobs)))
+        for _ in analyzers:
+            await analyze_q.put(None)
+        await asyncio.gather(*analyzers)
+        for _ in persisters:
+            await persist_q.put(None)
+        await asyncio.gather(*persisters)
+    finally:
+        for task in analyzers + persisters:
+            task.cancel()
+
+    return results
@@ -2,7 +2,7 @@ from quart import Quart, request, jsonify, Response
 from quart_cors import cors
 from werkzeug.utils import secure_filename
 from uploader import Uploader
-from extractor import Extractor 
+from extractor import ExtractionJob, Field, close_clients, init_clients, run_extraction_pipeline
 from database import Database
 from sorter import Sorter
 from form_mapping_utils import upload_bucket_mapping
@@ -15,6 +15,16 @@ import io
 app = Quart(__name__)
 app = cors(app)
 
+@app.before_serving
+async def startup():
+    await Database.init_pool()
+    init_clients()
+
+@app.after_serving
+async def shutdown():
+    await Database.close_pool()
+    await close_clients()
+
 @app.route('/process_doc', methods=['POST'])
 async def process_doc():
     form = await request.form
@@ -23,31 +33,51 @@ async def process_doc():
     form_types = form.getlist('formTypes[]')
     uploaded_files = (await request.files).getlist('files[]')
 
-    tasks = []
-
-    for uploaded_file, form_type in zip(uploaded_files, form_types):
-        tasks.append(handle_file(client_id, uploaded_file, form_type, version_id))
-
-    responses = await asyncio.gather(*tasks)
+    file_entries = list(zip(uploaded_files, form_types))
+    responses = [None] * len(file_entries)
+
+    async def upload_and_prepare(idx, uploaded_file, form_type):
+        """Uploads one file and returns its extraction job, or None when there is nothing to extract."""
+        try:
+            blob_url = await upload_file(client_id, uploaded_file, form_type, version_id)
+        except Exception as e:
+            print(f"Upload failed for '{uploaded_file.filename}': {e}")
+            blob_url = None
+
+        if not blob_url:
+            responses[idx] = {"status": "Error", "error": "Upload failed"}
+            return None
+        if form_type == 'None':
+            responses[idx] = {"status": "Upload Completed", "uploaded_file": blob_url}
+            return None
+
+        filename = secure_filename(uploaded_file.filename)
+        return ExtractionJob(
+            client_id=client_id,
+            container_name=upload_bucket_mapping[form_type],
+            blob_name=sanitize_blob_name(filename),
+            doc_name=filename,
+            form_type=form_type,
+            access_id=version_id,
+        )
+
+    # Each file enters analysis as soon as its own upload finishes, and analysis
+    # of one document overlaps with the database write of another
+    results = await run_extraction_pipeline([
+        upload_and_prepare(idx, uploaded_file, form_type)
+        for idx, (uploaded_file, form_type) in enumerate(file_entries)
+    ])
+    for idx, result in enumerate(results):
+        if responses[idx] is not None:
+            continue
+        if isinstance(result, Exception):
+            # Details are logged by the pipeline; they can contain endpoints and SAS tokens
+            responses[idx] = {"status": "Error", "error": "Extraction failed"}
+        else:
+            responses[idx] = {"status": "Extract Completed", "xml": build_extraction_xml(result)}
 
     return jsonify(responses)
 
-async def handle_file(client_id, uploaded_file, form_type, version_id):
-    filename = secure_filename(uploaded_file.filename)
-    blob_url = await upload_file(client_id, uploaded_file, form_type, version_id)
-
-    if not blob_url:
-        return {"status": "Error", "error": "Upload failed"}
-
-    if form_type != 'None':
-        xml_str = await extract_data(client_id, filename, upload_bucket_mapping[form_type], form_type, version_id)
-        if xml_str:
-            return {"status": "Extract Completed", "xml": xml_str}
-        else:
-            return {"status": "Empty Extraction"}
-    else:
-        return {"status": "Upload Completed", "uploaded_file": blob_url}
-
 async def upload_file(client_id, uploaded_file, form_type, version_id):
     bucket_name = upload_bucket_mapping.get(form_type, 'unsorted')
     uploader = Uploader(bucket_name)
@@ -57,11 +87,7 @@ async def upload_file(client_id, uploaded_file, form_type, version_id):
         await database.post2postgres_upload(client_id, blob_url, 'uploaded', form_type, bucket_name, version_id)
     return blob_url
 
-async def extract_data(client_id, filename, bucket_name, form_type, version_id):
-    sanitized_blob_name = sanitize_blob_name(filename)
-    extractor = Extractor(bucket_name)
-    extracted_values, blob_sas_url = await extractor.extract(client_id, sanitized_blob_name, form_type)
-    await extractor.update_database(client_id, blob_sas_url, filename, form_type, extracted_values, version_id)
+def build_extraction_xml(extracted_values):
     root = ET.Element("W2s")
     for extracted_value in extracted_values:
         w2_element = ET.SubElement(root, "W2")
@@ -69,6 +95,9 @@ async def extract_data(client_id, filename, bucket_name, form_type, version_id):
             if key == 'confidence':
                 w2_element.set('confidence', str(value))
             else:
+                if isinstance(value, Field):
+                    # Keep the {'value': ..., 'confidence': ...} text the XML has always carried
+                    value = value._asdict()
                 ET.SubElement(w2_element, key).text = str(value) if value is not None else None
     xml_str = ET.tostring(root, encoding='utf-8').decode('utf-8')
     
@@ -90,8 +119,6 @@ async def download_csv(document_id):
     print(sanitized_doc_id)  
     csv_content = await db.generate_csv(sanitized_doc_id, client_id)
 
-    await db.close()
-
     response = Response(csv_content, mimetype='text/csv')
     response.headers["Content-Disposition"] = f"attachment; filename={document_id}.csv" 
     
@@ -132,6 +159,12 @@ async def sort():
 
 
 if __name__ == "__main__":
+    # uvloop is not available on Windows; fall back to the default loop there
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     app.run(debug=True)
     
     #main branch
\ No newline at end of file
@@ -1,15 +1,9 @@
-import asyncpg
-import json
+import orjson
+from database import Database
 
 class TableBuilder:
     async def __aenter__(self):
-        self.conn = await asyncpg.connect(
-            database="postgres",
-            user="postgres",
-            password="kr3310",
-            host="localhost",
-            port="5432"
-        )
+        self.conn = await Database.pool.acquire()
         return self
 
     async def fetch_client_data(self, client_id):
@@ -21,7 +15,7 @@ class TableBuilder:
             'client_docs': client_docs_data,
         }
 
-        return json.dumps(final_data)
+        return orjson.dumps(final_data).decode()
 
     async def __aexit__(self, exc_type, exc, tb):
-        await self.conn.close()
\ No newline at end of file
+        await Database.pool.release(self.conn)
\ No newline at end of file